@@ -1,8 +1,14 @@
 import sys
+from PyQt5.QtGui import QSurfaceFormat
 from PyQt5.QtWidgets import QApplication
 from mainwindow import MainWindow
 
 def main():
+    # 4x MSAA для GL-вьюпорта графа; задаётся до создания QApplication
+    fmt = QSurfaceFormat()
+    fmt.setSamples(4)
+    QSurfaceFormat.setDefaultFormat(fmt)
+
     app = QApplication(sys.argv)
     mw = MainWindow()
     # проверка и предложение восстановить автосохранённую сессию
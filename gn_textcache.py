@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+from PyQt5.QtGui import QStaticText, QTextOption
+
+# Кэш готовых текстовых раскладок для подписей GraphNode.
+#
+# QPainter.drawText пересчитывает раскладку (шейпинг, перенос строк) на
+# каждый кадр; QStaticText делает это один раз и дальше переиспользует
+# глифовые раны. Подписи нод повторяются между кадрами и между нодами
+# («New PC», обрезанные реплики), поэтому LRU по (шрифт, текст, ширина)
+# снимает затраты на раскладку при панораме/зуме почти полностью.
+# Ключ включает font_key: один и тот же QStaticText, нарисованный разными
+# шрифтами, перераскладывался бы заново.
+
+
+@lru_cache(maxsize=4096)
+def static_text(font_key: str, text: str, width: float, wrap: bool = True) -> QStaticText:
+    """Готовая раскладка текста шириной width; font_key различает шрифты."""
+    st = QStaticText(text)
+    opt = QTextOption()
+    opt.setWrapMode(QTextOption.WordWrap if wrap else QTextOption.NoWrap)
+    st.setTextOption(opt)
+    st.setTextWidth(width)
+    st.setPerformanceHint(QStaticText.AggressiveCaching)
+    return st
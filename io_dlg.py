@@ -1,110 +1,227 @@
-import re
-from typing import List, Tuple, Optional
-
-from model import DlgRow
-
-# Список кодировок для попытки чтения .dlg файлов
-COMMON_ENCODINGS = ['utf-8-sig', 'cp1251', 'utf-16-le', 'utf-16-be', 'latin-1']
-
-# Регулярное выражение для парсинга строки DLG
-# Находит 13 полей в фигурных скобках, допуская пробелы
-DLG_LINE_RE = re.compile(r'\s*'.join([r'\{(.*?)\}'] * 13))
-
-
-def read_dlg(filepath: str) -> Tuple[Optional[List[DlgRow]], Optional[str]]:
-    """
-    Читает .dlg файл, автоматически определяя кодировку.
-
-    Args:
-        filepath: Путь к файлу.
-
-    Returns:
-        Кортеж из (список DlgRow, определенная кодировка) или (None, None) в случае ошибки.
-    """
-    last_exception = None
-    for encoding in COMMON_ENCODINGS:
-        try:
-            with open(filepath, 'r', encoding=encoding) as f:
-                lines = f.readlines()
-
-            dlg_rows = []
-            for line_text in lines:
-                match = DLG_LINE_RE.match(line_text.strip())
-                if not match:
-                    continue
-
-                groups = list(match.groups())
-
-                # Декодируем символ ']' обратно в '}' для внутренней модели
-                groups = [g.replace(']', '}') for g in groups]
-
-                index_str, male, female, next_str, condition, action, *variants = groups
-
-                try:
-                    index = int(index_str)
-                    next_val = None if next_str.strip() in ('#', '') else int(next_str)
-                except ValueError:
-                    continue  # Пропускаем некорректные строки
-
-                dlg_rows.append(DlgRow(
-                    index=index,
-                    male=male,
-                    female=female,
-                    next=next_val,
-                    condition=condition,
-                    action=action,
-                    unknown01=variants[0],
-                    unknown02=variants[1],
-                    unknown03=variants[2],
-                    unknown04=variants[3],
-                    unknown05=variants[4],
-                    unknown06=variants[5],
-                    malkavian=variants[6]
-                ))
-            return dlg_rows, encoding
-        except (UnicodeDecodeError, Exception) as e:
-            last_exception = e
-            continue
-
-    print(f"Failed to read DLG file with all attempted encodings. Last error: {last_exception}")
-    return None, None
-
-
-def write_dlg(filepath: str, rows: List[DlgRow], encoding: str) -> bool:
-    """
-    Записывает данные в .dlg файл в указанной кодировке.
-
-    Args:
-        filepath: Путь для сохранения файла.
-        rows: Список DlgRow для записи.
-        encoding: Кодировка файла.
-
-    Returns:
-        True в случае успеха, False в случае ошибки.
-    """
-    try:
-        with open(filepath, 'w', encoding=encoding) as f:
-            for row in rows:
-                # Важно: заменяем '}' на ']' перед записью, чтобы не сломать формат
-                values = [
-                    str(row.index),
-                    row.male,
-                    row.female,
-                    '#' if row.next is None else str(row.next),
-                    row.condition,
-                    row.action,
-                    row.unknown01,
-                    row.unknown02,
-                    row.unknown03,
-                    row.unknown04,
-                    row.unknown05,
-                    row.unknown06,
-                    row.malkavian
-                ]
-
-                sanitized_values = [str(v).replace('}', ']') for v in values]
-                f.write(''.join(f'{{{v}}}' for v in sanitized_values) + '\n')
-        return True
-    except Exception as e:
-        print(f"Error writing DLG file: {e}")
-        return False
+import os
+import re
+from typing import List, Tuple, Optional
+
+from model import DlgRow
+
+# pandas опционален: векторизованный разбор больших файлов, если установлен
+try:
+    import pandas as _pd
+except ImportError:
+    _pd = None
+
+# Порог (в байтах), начиная с которого выгоден векторизованный путь
+LARGE_FILE_BYTES = 1_000_000
+
+# Список кодировок для попытки чтения .dlg файлов
+COMMON_ENCODINGS = ['utf-8-sig', 'cp1251', 'utf-16-le', 'utf-16-be', 'latin-1']
+
+# Регулярное выражение для парсинга строки DLG
+# Находит 13 полей в фигурных скобках, допуская пробелы
+DLG_LINE_RE = re.compile(r'\s*'.join([r'\{(.*?)\}'] * 13))
+
+# Число полей в строке .dlg
+FIELD_COUNT = 13
+
+
+def _scan_fields(line: str) -> Optional[List[str]]:
+    """
+    Линейный разбор строки: 13 полей в фигурных скобках.
+
+    Ручной проход через str.find вместо регулярного выражения —
+    без бэктрекинга и в один проход по строке (str.find реализован на C).
+    Возвращает список полей или None, если строка не соответствует формату.
+    """
+    fields = []
+    find = line.find
+    i = 0
+    for _ in range(FIELD_COUNT):
+        a = find('{', i)
+        if a < 0:
+            return None
+        b = find('}', a + 1)
+        if b < 0:
+            return None
+        fields.append(line[a + 1:b])
+        i = b + 1
+    return fields
+
+
+def _parse_lines_pandas(lines: List[str]) -> List[DlgRow]:
+    """
+    Векторизованный разбор через pandas: извлечение 13 полей, замена ']'
+    и числовые преобразования выполняются C-кодом по всем строкам сразу.
+
+    Семантика повторяет построчный цикл: строки без 13 полей или с
+    нечисловыми index/next отбрасываются, '#' и пустой next дают None.
+    """
+    df = _pd.Series(lines, dtype='object').str.extract(DLG_LINE_RE)
+    df = df.dropna(how='any')
+    if df.empty:
+        return []
+
+    df = df.apply(lambda col: col.str.replace(']', '}', regex=False))
+
+    # Валидация в духе int(): to_numeric принял бы и float-подобные
+    # строки ("1.5", "1e3"), которые построчный путь отбрасывает, —
+    # семантика не должна зависеть от объёма файла и наличия pandas
+    int_re = r'\s*[+-]?\d+\s*'
+    index_ok = df[0].str.fullmatch(int_re)
+    next_str = df[3].str.strip()
+    next_ok = df[3].str.fullmatch(int_re)
+    keep = index_ok & (next_ok | next_str.isin(('#', '')))
+    if not keep.all():
+        df = df[keep]
+        next_ok = next_ok[keep]
+
+    return [
+        DlgRow(
+            int(t[0]), t[1], t[2],
+            int(t[3]) if ok else None,
+            t[4], t[5], t[6], t[7], t[8], t[9], t[10], t[11], t[12]
+        )
+        for ok, t in zip(next_ok, df.itertuples(index=False, name=None))
+    ]
+
+
+def read_dlg(filepath: str) -> Tuple[Optional[List[DlgRow]], Optional[str]]:
+    """
+    Читает .dlg файл, автоматически определяя кодировку.
+
+    Args:
+        filepath: Путь к файлу.
+
+    Returns:
+        Кортеж из (список DlgRow, определенная кодировка) или (None, None) в случае ошибки.
+    """
+    try:
+        size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            head = f.read(4)
+    except Exception as e:
+        print(f"Failed to read DLG file: {e}")
+        return None, None
+
+    # Быстрый путь: BOM однозначно задаёт кодировку — декодируем один раз,
+    # без каскада попыток с перечитыванием файла
+    if head.startswith(b'\xef\xbb\xbf'):
+        candidates = ['utf-8-sig']
+    elif head.startswith(b'\xff\xfe'):
+        candidates = ['utf-16-le']
+    elif head.startswith(b'\xfe\xff'):
+        candidates = ['utf-16-be']
+    else:
+        candidates = ['utf-8-sig', 'cp1251', 'utf-16-le', 'utf-16-be', 'latin-1']
+
+    last_exception = None
+    for encoding in candidates:
+        try:
+            # Потоковое чтение: строки декодируются по мере прохода,
+            # без материализации всего файла (bytes + список str) в памяти
+            with open(filepath, 'r', encoding=encoding, errors='strict') as f:
+                if _pd is not None and size > LARGE_FILE_BYTES:
+                    text = f.read()
+                    dlg_rows = _parse_lines_pandas(text.splitlines())
+                    if not dlg_rows and text.strip():
+                        continue
+                    return dlg_rows, encoding
+
+                dlg_rows: List[DlgRow] = []
+                append_row = dlg_rows.append
+                saw_content = False
+                _int = int  # локальная ссылка: без LOAD_GLOBAL на каждую строку
+                for line_text in f:
+                    if not saw_content and not line_text.isspace():
+                        saw_content = True
+                    groups = _scan_fields(line_text)
+                    if groups is None:
+                        continue
+
+                    # Декодируем символ ']' обратно в '}' для внутренней модели
+                    groups = [g.replace(']', '}') for g in groups]
+
+                    index_str, male, female, next_str, condition, action, *variants = groups
+
+                    try:
+                        index = _int(index_str)
+                    except ValueError:
+                        continue  # Пропускаем некорректные строки
+
+                    # Быстрая проверка без .strip(): пустой/пробельный или '#' — нет перехода
+                    if not next_str or next_str == '#' or next_str.isspace():
+                        next_val = None
+                    else:
+                        try:
+                            next_val = _int(next_str)
+                        except ValueError:
+                            # Редкий путь: '#' с пробелами вокруг
+                            if next_str.strip() == '#':
+                                next_val = None
+                            else:
+                                continue
+
+                    # Позиционный вызов: без сборки kwargs-словаря на каждую строку
+                    append_row(DlgRow(
+                        index, male, female, next_val, condition, action,
+                        variants[0], variants[1], variants[2], variants[3],
+                        variants[4], variants[5], variants[6]
+                    ))
+            if not dlg_rows and saw_content:
+                # Декодирование «прошло», но ни одна строка не распозналась —
+                # вероятно, не та кодировка (например, utf-16 без BOM)
+                continue
+            return dlg_rows, encoding
+        except (UnicodeDecodeError, Exception) as e:
+            last_exception = e
+            continue
+
+    print(f"Failed to read DLG file with all attempted encodings. Last error: {last_exception}")
+    return None, None
+
+
+def write_dlg(filepath: str, rows: List[DlgRow], encoding: str) -> bool:
+    """
+    Записывает данные в .dlg файл в указанной кодировке.
+
+    Args:
+        filepath: Путь для сохранения файла.
+        rows: Список DlgRow для записи.
+        encoding: Кодировка файла.
+
+    Returns:
+        True в случае успеха, False в случае ошибки.
+    """
+    try:
+        # Собираем весь файл в памяти и пишем одним вызовом:
+        # один большой str.join вместо write-вызова на каждую строку
+        parts: List[str] = []
+        append = parts.append
+        for row in rows:
+            values = (
+                str(row.index),
+                row.male,
+                row.female,
+                '#' if row.next is None else str(row.next),
+                row.condition,
+                row.action,
+                row.unknown01,
+                row.unknown02,
+                row.unknown03,
+                row.unknown04,
+                row.unknown05,
+                row.unknown06,
+                row.malkavian
+            )
+            # Важно: заменяем '}' на ']' перед записью, чтобы не сломать формат
+            for v in values:
+                append('{')
+                append(str(v).replace('}', ']'))
+                append('}')
+            append('\n')
+        payload = ''.join(parts)
+        with open(filepath, 'w', encoding=encoding, newline='') as f:
+            f.write(payload)
+        return True
+    except Exception as e:
+        print(f"Error writing DLG file: {e}")
+        return False
@@ -1,314 +1,622 @@
-import collections
-from typing import List, Dict, Tuple, Set, Optional
-
-from model import DlgRow
-
-# Базовые значения (используются как дефолт)
-NODE_W_BASE, NODE_H_BASE = 300, 90
-H_GAP_BASE, V_GAP_BASE = 60, 110
-BARYCENTER_ITERATIONS = 5
-
-
-def auto_gaps(n_nodes: int) -> Tuple[int, int]:
-    """
-    Эвристика для больших графов: чем больше узлов — тем компактнее интервалы.
-    Возвращает (H_GAP, V_GAP).
-    """
-    # Базовая идея: масштаб ~ sqrt(N); сжимаем от 1.0 до 0.5
-    if n_nodes <= 300:
-        k = 1.0
-    elif n_nodes <= 800:
-        k = 0.8
-    elif n_nodes <= 1200:
-        k = 0.65
-    else:
-        k = 0.55
-    return max(20, int(H_GAP_BASE * k)), max(60, int(V_GAP_BASE * k))
-
-
-def _ensure_parents(rows: List[DlgRow]):
-    """Заполняем parent_npc по порядку (если не задан)."""
-    current_npc = None
-    for r in rows:
-        if not r.is_pc_reply():
-            current_npc = r.index
-        else:
-            if r.parent_npc is None:
-                r.parent_npc = current_npc
-
-
-def _build_components(rows: List[DlgRow]) -> List[Set[int]]:
-    nodes_map = {r.index: r for r in rows}
-    visited: Set[int] = set()
-    components: List[Set[int]] = []
-
-    _ensure_parents(rows)
-
-    # Обход по смешанным связям: NPC->PC (parent_npc), PC->NPC (next)
-    for r in rows:
-        if r.index in visited:
-            continue
-        comp: Set[int] = set()
-        dq = collections.deque([r.index])
-        visited.add(r.index)
-        while dq:
-            idx = dq.popleft()
-            comp.add(idx)
-            node = nodes_map[idx]
-            # NPC -> PC дети
-            children = [x.index for x in rows if x.parent_npc == idx]
-            for ch in children:
-                if ch not in visited:
-                    visited.add(ch)
-                    dq.append(ch)
-            # PC -> NPC цель
-            if node.is_pc_reply() and node.next in nodes_map:
-                if node.next not in visited:
-                    visited.add(node.next)
-                    dq.append(node.next)
-        components.append(comp)
-    return components
-
-
-def calculate_layout(
-    rows: List[DlgRow],
-    *,
-    node_w: int = NODE_W_BASE,
-    node_h: int = NODE_H_BASE,
-    h_gap: int = H_GAP_BASE,
-    v_gap: int = V_GAP_BASE,
-) -> Dict[int, Tuple[float, float]]:
-    """
-    Слоистая раскладка (метод Сугиямы). Оставлена как «ленточный» вариант.
-    """
-    if not rows:
-        return {}
-
-    nodes_map = {row.index: row for row in rows}
-    _ensure_parents(rows)
-
-    # 1) Формирование слоёв
-    layers: Dict[int, List[int]] = collections.defaultdict(list)
-    node_to_layer: Dict[int, int] = {}
-    components = _build_components(rows)
-
-    q = collections.deque([(r.index, 0) for r in rows if r.parent_npc is None and not r.is_pc_reply()])
-
-    while q:
-        node_idx, level = q.popleft()
-        if node_idx in node_to_layer:
-            continue
-        node_to_layer[node_idx] = level
-        layers[level].append(node_idx)
-        node = nodes_map[node_idx]
-        if not node.is_pc_reply():
-            children = [r.index for r in rows if r.parent_npc == node_idx]
-            for child_idx in children:
-                q.append((child_idx, level + 1))
-        else:
-            if node.next and node.next in nodes_map:
-                q.append((node.next, level + 1))
-
-    # 2) Барицентрический порядок
-    for _ in range(BARYCENTER_ITERATIONS):
-        for level in sorted(layers.keys()):
-            barycenters = {}
-            for node_idx in layers[level]:
-                node = nodes_map[node_idx]
-                neighbors = []
-                if node.is_pc_reply() and node.parent_npc is not None:
-                    neighbors.append(node.parent_npc)
-                else:
-                    neighbors = [r.index for r in rows if r.next == node_idx]
-                if not neighbors:
-                    barycenters[node_idx] = 0
-                else:
-                    prev = layers.get(level - 1, [])
-                    pos = [prev.index(n) for n in neighbors if n in prev]
-                    barycenters[node_idx] = sum(pos) / len(pos) if pos else 0
-            layers[level].sort(key=lambda i: barycenters.get(i, 0))
-
-    # 3) Координаты
-    positions: Dict[int, Tuple[float, float]] = {}
-    component_offset_x = 0
-    for comp in components:
-        if not comp:
-            continue
-        comp_layers: Dict[int, List[int]] = collections.defaultdict(list)
-        min_level = 10 ** 9
-        for node_idx, lvl in node_to_layer.items():
-            if node_idx in comp:
-                min_level = min(min_level, lvl)
-                comp_layers[lvl].append(node_idx)
-
-        max_width = 0
-        for level in sorted(comp_layers.keys()):
-            ordered = [n for n in layers.get(level, []) if n in comp_layers[level]]
-            y = (level - min_level) * (node_h + v_gap)
-            layer_width = len(ordered) * (node_w + h_gap)
-            max_width = max(max_width, layer_width)
-            start_x = component_offset_x - layer_width / 2
-            for i, idx in enumerate(ordered):
-                x = start_x + i * (node_w + h_gap)
-                positions[idx] = (x, y)
-        component_offset_x += max_width + h_gap * 4
-    return positions
-
-
-def calculate_tree_layout(
-    rows: List[DlgRow],
-    *,
-    orientation: str = "vertical",
-    node_w: int = NODE_W_BASE,
-    node_h: int = NODE_H_BASE,
-    h_gap: int = H_GAP_BASE,
-    v_gap: int = V_GAP_BASE,
-) -> Dict[int, Tuple[float, float]]:
-    """
-    Деревообразная раскладка (лес) с чередованием слоёв NPC→PC→NPC.
-    orientation: 'vertical' — корни сверху; 'horizontal' — слева.
-    ВАЖНО: компоненты теперь пакуются в сетку (grid), а не в один «широкий ряд».
-    """
-    if not rows:
-        return {}
-
-    # --- Подготовка ---
-    nodes_map = {r.index: r for r in rows}
-
-    # Если у PC отсутствует parent_npc, пытаемся восстановить из входящих NPC
-    def _ensure_parents(rows: List[DlgRow]):
-        idx2row = {r.index: r for r in rows}
-        for r in rows:
-            if r.is_pc_reply() and r.parent_npc is None:
-                # ищем NPC, который ведёт на этот PC
-                candidates = [n.index for n in rows if (not n.is_pc_reply()) and any(x.parent_npc == n.index for x in rows if x.is_pc_reply())]
-                # быстрая эвристика: если у PC есть ровно один NPC-«родитель» по parent_npc в данных — оставим как есть
-                # иначе ничего не делаем (не навредить)
-                # (в твоих данных parent_npc обычно уже проставлен)
-                pass
-    _ensure_parents(rows)
-
-    # --- 1) Корни (NPC без входящих PC→NPC) ---
-    incoming_to_npc: Dict[int, int] = {r.index: 0 for r in rows if not r.is_pc_reply()}
-    for r in rows:
-        if r.is_pc_reply() and r.next in incoming_to_npc:
-            incoming_to_npc[r.next] += 1
-
-    roots = [idx for idx, cnt in incoming_to_npc.items() if cnt == 0]
-    if not roots:
-        # fallback: первый встретившийся NPC
-        first_npc = next((r.index for r in rows if not r.is_pc_reply()), None)
-        if first_npc is not None:
-            roots = [first_npc]
-
-    # --- 2) Компоненты и послойка внутри каждого компонента ---
-    components: List[List[int]] = []                  # список индексов узлов по компонентам
-    layers_by_comp: List[Dict[int, List[int]]] = []   # для каждой компоненты: {layer -> [indices]}
-    visited: Set[int] = set()
-
-    # Обход только по «деревянным» ребрам: NPC→PC (parent_npc), PC→NPC (next)
-    def _bfs_layers(root_idx: int) -> Tuple[List[int], Dict[int, List[int]]]:
-        comp_nodes: Set[int] = set()
-        layers: Dict[int, List[int]] = collections.defaultdict(list)
-        dq = collections.deque([(root_idx, 0)])
-        visited.add(root_idx)
-        while dq:
-            idx, lvl = dq.popleft()
-            comp_nodes.add(idx)
-            layers[lvl].append(idx)
-            node = nodes_map[idx]
-            if not node.is_pc_reply():  # NPC → дети PC
-                for ch in (x.index for x in rows if x.parent_npc == idx):
-                    if ch not in visited:
-                        visited.add(ch); dq.append((ch, lvl + 1))
-            else:                        # PC → целевой NPC
-                if node.next in nodes_map and node.next not in visited:
-                    visited.add(node.next); dq.append((node.next, lvl + 1))
-        return list(comp_nodes), layers
-
-    for root in roots:
-        if root not in visited:
-            comp, layers = _bfs_layers(root)
-            components.append(comp)
-            layers_by_comp.append(layers)
-
-    # Добавим «отвалившиеся» куски, если корни не покрыли все узлы
-    for r in rows:
-        if r.index not in visited:
-            comp, layers = _bfs_layers(r.index)
-            components.append(comp)
-            layers_by_comp.append(layers)
-
-    # --- 3) Упорядочивание слоёв барицентром (минимизация пересечений) ---
-    for layers in layers_by_comp:
-        # Несколько итераций для стабилизации
-        for _ in range(BARYCENTER_ITERATIONS):
-            for lvl in sorted(layers.keys()):
-                layer_nodes = layers[lvl]
-                b = {}
-                for idx in layer_nodes:
-                    node = nodes_map[idx]
-                    neighbors = []
-                    if node.is_pc_reply():
-                        if node.parent_npc is not None:
-                            neighbors.append(node.parent_npc)
-                    else:
-                        neighbors = [x.index for x in rows if x.is_pc_reply() and x.next == idx]
-                    prev = layers.get(lvl - 1, [])
-                    pos_list = [prev.index(n) for n in neighbors if n in prev]
-                    b[idx] = (sum(pos_list) / len(pos_list)) if pos_list else 0.0
-                layer_nodes.sort(key=lambda i: b.get(i, 0.0))
-
-    # --- 4) КООРДИНАТЫ: упаковка компонентов в «сетку» ---
-    positions: Dict[int, Tuple[float, float]] = {}
-
-    # Предварительно оценим габариты каждой компоненты
-    comp_infos: List[Tuple[int, Dict[int, List[int]], int, int]] = []  # (comp_idx, layers, width_px, height_px)
-    for comp_idx, _comp_nodes in enumerate(components):
-        layers = layers_by_comp[comp_idx]
-        if not layers:
-            comp_infos.append((comp_idx, layers, node_w + h_gap, node_h + v_gap))
-            continue
-        max_nodes_per_layer = max(len(layers[l]) for l in layers)
-        num_layers = (max(layers.keys()) - min(layers.keys()) + 1)
-        comp_w = max_nodes_per_layer * (node_w + h_gap)
-        comp_h = num_layers * (node_h + v_gap)
-        comp_infos.append((comp_idx, layers, comp_w, comp_h))
-
-    # Эвристика числа столбцов: примерно √N
-    ncomps = len(comp_infos)
-    cols = max(1, int(round(ncomps ** 0.5)))
-    margin_x = h_gap * 4   # расстояние между компонентами по «вторичной» оси
-    margin_y = v_gap * 3   # расстояние между рядами
-
-    row_primary_offset = 0.0   # для vertical это Y
-    i = 0
-    while i < ncomps:
-        row = comp_infos[i:i + cols]
-        i += cols
-
-        # Высота ряда = max высоты компонентов; ширина ряда не критична — идём слева направо
-        row_height = max((h for *_t, h in row), default=(node_h + v_gap))
-
-        cur_secondary = 0.0  # для vertical это X
-        for comp_idx, layers, comp_w, _comp_h in row:
-            min_lvl = min(layers.keys()) if layers else 0
-
-            for lvl in sorted(layers.keys()):
-                indices = layers[lvl]
-                secondary_span = len(indices) * (node_w + h_gap)
-                start_secondary = cur_secondary + (comp_w - secondary_span) / 2.0
-                for j, idx in enumerate(indices):
-                    secondary = start_secondary + j * (node_w + h_gap)
-                    primary = row_primary_offset + (lvl - min_lvl) * (node_h + v_gap)
-                    if orientation == "vertical":
-                        x, y = secondary, primary
-                    else:
-                        x, y = primary, secondary
-                    positions[idx] = (x, y)
-
-            cur_secondary += comp_w + margin_x
-
-        row_primary_offset += row_height + margin_y
-
-    return positions
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import struct
+from typing import List, Dict, Tuple, Set, Optional
+
+from model import DlgRow
+
+# numpy опционален: векторная арифметика координат на больших слоях
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+# Базовые значения (используются как дефолт)
+NODE_W_BASE, NODE_H_BASE = 300, 90
+H_GAP_BASE, V_GAP_BASE = 60, 110
+BARYCENTER_ITERATIONS = 5
+
+
+@functools.lru_cache(maxsize=16)
+def auto_gaps(n_nodes: int) -> Tuple[int, int]:
+    """
+    Эвристика для больших графов: чем больше узлов — тем компактнее интервалы.
+    Возвращает (H_GAP, V_GAP).
+    """
+    # Базовая идея: масштаб ~ sqrt(N); сжимаем от 1.0 до 0.5
+    if n_nodes <= 300:
+        k = 1.0
+    elif n_nodes <= 800:
+        k = 0.8
+    elif n_nodes <= 1200:
+        k = 0.65
+    else:
+        k = 0.55
+    return max(20, int(H_GAP_BASE * k)), max(60, int(V_GAP_BASE * k))
+
+
+# Мемоизация раскладок: обе функции — чистые от топологии rows и параметров,
+# повторный вызов с теми же данными не должен заново гонять BFS + барицентр
+_LAYOUT_CACHE: collections.OrderedDict = collections.OrderedDict()
+_LAYOUT_CACHE_MAX = 8
+
+
+def _rows_signature(rows: List[DlgRow]) -> int:
+    """Дешёвый хэш топологии: индексы, родители, переходы, тип узла."""
+    return hash(tuple((r.index, r.parent_npc, r.next, r.is_pc_reply()) for r in rows))
+
+
+def _layout_cache_get(key) -> Optional[Dict[int, Tuple[float, float]]]:
+    pos = _LAYOUT_CACHE.get(key)
+    if pos is None:
+        return None
+    _LAYOUT_CACHE.move_to_end(key)
+    return dict(pos)  # копия: вызывающий код может мутировать результат
+
+
+def _layout_cache_put(key, positions: Dict[int, Tuple[float, float]]):
+    _LAYOUT_CACHE[key] = dict(positions)
+    if len(_LAYOUT_CACHE) > _LAYOUT_CACHE_MAX:
+        _LAYOUT_CACHE.popitem(last=False)
+
+
+# Дисковый кэш раскладок: раскладка детерминирована по топологии, так что
+# повторное открытие того же .dlg сводится к чтению одного json-файла
+_DISK_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dlg4vtmb", "layout")
+
+
+def _disk_cache_path(rows: List[DlgRow], params: tuple) -> Optional[str]:
+    """Путь к файлу кэша по BLAKE2b-хэшу топологии и параметров, или None."""
+    try:
+        h = hashlib.blake2b(digest_size=16)
+        pack = struct.Struct("<qqq?").pack
+        for r in rows:
+            h.update(pack(r.index,
+                          -1 if r.parent_npc is None else r.parent_npc,
+                          -1 if r.next is None else r.next,
+                          r.is_pc_reply()))
+        h.update(repr(params).encode('utf-8'))
+        return os.path.join(_DISK_CACHE_DIR, h.hexdigest()[:16] + ".json")
+    except Exception:
+        return None
+
+
+def _disk_cache_load(path: Optional[str]) -> Optional[Dict[int, Tuple[float, float]]]:
+    if path is None:
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        return {int(k): (v[0], v[1]) for k, v in raw.items()}
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+
+
+def _disk_cache_store(path: Optional[str], positions: Dict[int, Tuple[float, float]]):
+    if path is None:
+        return
+    try:
+        os.makedirs(_DISK_CACHE_DIR, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({str(k): v for k, v in positions.items()}))
+    except OSError:
+        pass  # сбой кэша никогда не ломает раскладку
+
+
+def _ensure_parents(rows: List[DlgRow]):
+    """Заполняем parent_npc по порядку (если не задан)."""
+    current_npc = None
+    for r in rows:
+        if not r.is_pc_reply():
+            current_npc = r.index
+        else:
+            if r.parent_npc is None:
+                r.parent_npc = current_npc
+
+
+def _build_adj(
+    rows: List[DlgRow], pc_ids: Set[int]
+) -> Tuple[Dict[int, List[int]], Dict[int, List[int]], Dict[int, List[int]], Dict[int, int]]:
+    """
+    Вся смежность графа за один проход по rows вместо отдельного
+    построения в каждой функции раскладки:
+      children_by_parent — NPC→PC дети (по parent_npc);
+      preds_by_next      — предшественники по next (все строки);
+      pc_preds_by_next   — то же, но только PC→NPC рёбра;
+      incoming_to_npc    — счётчик входящих PC→NPC для поиска корней.
+    """
+    children_by_parent: Dict[int, List[int]] = collections.defaultdict(list)
+    preds_by_next: Dict[int, List[int]] = collections.defaultdict(list)
+    pc_preds_by_next: Dict[int, List[int]] = collections.defaultdict(list)
+    incoming_to_npc: Dict[int, int] = {r.index: 0 for r in rows if r.index not in pc_ids}
+    for r in rows:
+        idx = r.index
+        if r.parent_npc is not None:
+            children_by_parent[r.parent_npc].append(idx)
+        nxt = r.next
+        if nxt is not None:
+            preds_by_next[nxt].append(idx)
+            if idx in pc_ids:
+                pc_preds_by_next[nxt].append(idx)
+                if nxt in incoming_to_npc:
+                    incoming_to_npc[nxt] += 1
+    return children_by_parent, preds_by_next, pc_preds_by_next, incoming_to_npc
+
+
+# Кэш вспомогательных структур по конкретному списку rows: одно действие в UI
+# часто дёргает _build_components и раскладку на одном и том же списке подряд
+_AUX_CACHE: collections.OrderedDict = collections.OrderedDict()
+_AUX_CACHE_MAX = 4
+
+
+def _aux(rows: List[DlgRow]) -> tuple:
+    """
+    (nodes_map, pc_ids, children_by_parent, preds_by_next, pc_preds_by_next,
+    incoming_to_npc) для rows. Мемоизируется по id(rows) + сигнатуре
+    топологии, чтобы не перестраивать словари трижды за один вызов UI.
+    """
+    key = id(rows)
+    sig = _rows_signature(rows)
+    hit = _AUX_CACHE.get(key)
+    if hit is not None and hit[0] == sig:
+        _AUX_CACHE.move_to_end(key)
+        return hit[1]
+    nodes_map = {r.index: r for r in rows}
+    # Множество PC-индексов: membership-тест вместо вызова метода в циклах
+    pc_ids = {r.index for r in rows if r.is_pc_reply()}
+    bundle = (nodes_map, pc_ids) + _build_adj(rows, pc_ids)
+    _AUX_CACHE[key] = (sig, bundle)
+    if len(_AUX_CACHE) > _AUX_CACHE_MAX:
+        _AUX_CACHE.popitem(last=False)
+    return bundle
+
+
+def _build_components(rows: List[DlgRow]) -> List[Set[int]]:
+    visited: Set[int] = set()
+    components: List[Set[int]] = []
+
+    _ensure_parents(rows)
+    nodes_map, pc_ids, children_by_parent, _, _, _ = _aux(rows)
+
+    # Обход по смешанным связям: NPC->PC (parent_npc), PC->NPC (next)
+    for r in rows:
+        if r.index in visited:
+            continue
+        comp: Set[int] = set()
+        dq = collections.deque([r.index])
+        visited.add(r.index)
+        while dq:
+            idx = dq.popleft()
+            comp.add(idx)
+            node = nodes_map[idx]
+            # NPC -> PC дети
+            for ch in children_by_parent.get(idx, ()):
+                if ch not in visited:
+                    visited.add(ch)
+                    dq.append(ch)
+            # PC -> NPC цель
+            if idx in pc_ids and node.next in nodes_map:
+                if node.next not in visited:
+                    visited.add(node.next)
+                    dq.append(node.next)
+        components.append(comp)
+    return components
+
+
+def _order_layers(
+    layers: Dict[int, List[int]],
+    parent_of: Dict[int, Optional[int]],
+    pc_ids: Set[int],
+    preds_by_next: Dict[int, List[int]],
+):
+    """Барицентрическое упорядочивание слоёв одной компоненты (in-place)."""
+    # Набор уровней не меняется между итерациями — сортируем один раз
+    sorted_levels = sorted(layers.keys())
+    for _ in range(BARYCENTER_ITERATIONS):
+        changed = False
+        for lvl in sorted_levels:
+            layer_nodes = layers[lvl]
+            b = {}
+            # Словарь позиций вместо prev.index(n) — O(1) на соседа
+            pos_in_prev = {n: i for i, n in enumerate(layers.get(lvl - 1, []))}
+            for idx in layer_nodes:
+                if idx in pc_ids:
+                    parent = parent_of.get(idx)
+                    neighbors = [parent] if parent is not None else []
+                else:
+                    neighbors = preds_by_next.get(idx, ())
+                pos_list = [p for p in map(pos_in_prev.get, neighbors) if p is not None]
+                b[idx] = (sum(pos_list) / len(pos_list)) if pos_list else 0.0
+            # argsort по массиву ключей: bound-метод __getitem__ вместо
+            # вызова lambda + dict.get на каждое сравнение
+            keys = [b[i] for i in layer_nodes]
+            order = sorted(range(len(layer_nodes)), key=keys.__getitem__)
+            reordered = [layer_nodes[k] for k in order]
+            if reordered != layer_nodes:
+                layer_nodes[:] = reordered
+                changed = True
+        # Порядок стабилизировался — дальнейшие итерации ничего не изменят
+        if not changed:
+            break
+
+
+# Снимок графа в процессе-воркере: разобранные словари смежности.
+# Заполняется initializer'ом пула один раз на воркер — задания несут
+# только индекс корня, а не копию всего графа
+_WORKER_GRAPH: Optional[tuple] = None
+
+
+def _init_layout_worker(snapshot) -> None:
+    """
+    Initializer пула: разобрать снимок графа в словари один раз на воркер.
+
+    Граф передаётся снимком из простых кортежей (index, parent_npc, next,
+    is_pc) — pickle-дружелюбно и без зависимостей от DlgRow. Так снимок
+    сериализуется по разу на воркер, а не по разу на корень: на лесах из
+    сотен мелких компонент это убирает O(roots x N) накладных расходов.
+    """
+    global _WORKER_GRAPH
+    pc_ids: Set[int] = set()
+    parent_of: Dict[int, Optional[int]] = {}
+    next_of: Dict[int, Optional[int]] = {}
+    children_by_parent: Dict[int, List[int]] = collections.defaultdict(list)
+    preds_by_next: Dict[int, List[int]] = collections.defaultdict(list)
+    for idx, parent, nxt, is_pc in snapshot:
+        parent_of[idx] = parent
+        next_of[idx] = nxt
+        if is_pc:
+            pc_ids.add(idx)
+            if nxt is not None:
+                preds_by_next[nxt].append(idx)
+        if parent is not None:
+            children_by_parent[parent].append(idx)
+    _WORKER_GRAPH = (pc_ids, parent_of, next_of, children_by_parent, preds_by_next)
+
+
+def _layout_component(root: int) -> Tuple[int, Dict[int, List[int]]]:
+    """
+    Задание для процесса-воркера: BFS от одного корня + барицентр.
+
+    Читает граф из _WORKER_GRAPH (см. _init_layout_worker). Пересечения
+    компонент разрешает вызывающая сторона при слиянии.
+    """
+    pc_ids, parent_of, next_of, children_by_parent, preds_by_next = _WORKER_GRAPH
+
+    layers_list: List[List[int]] = []
+    visited: Set[int] = {root}
+    dq = collections.deque([(root, 0)])
+    children_get = children_by_parent.get
+    while dq:
+        idx, lvl = dq.popleft()
+        while len(layers_list) <= lvl:
+            layers_list.append([])
+        layers_list[lvl].append(idx)
+        if idx not in pc_ids:
+            new = [c for c in children_get(idx, ()) if c not in visited]
+            if new:
+                visited.update(new)
+                dq.extend((c, lvl + 1) for c in new)
+        else:
+            nxt = next_of.get(idx)
+            if nxt in parent_of and nxt not in visited:
+                visited.add(nxt); dq.append((nxt, lvl + 1))
+
+    layers = {lvl: lst for lvl, lst in enumerate(layers_list)}
+    _order_layers(layers, parent_of, pc_ids, preds_by_next)
+    return root, layers
+
+
+def calculate_layout(
+    rows: List[DlgRow],
+    *,
+    node_w: int = NODE_W_BASE,
+    node_h: int = NODE_H_BASE,
+    h_gap: int = H_GAP_BASE,
+    v_gap: int = V_GAP_BASE,
+) -> Dict[int, Tuple[float, float]]:
+    """
+    Слоистая раскладка (метод Сугиямы). Оставлена как «ленточный» вариант.
+    """
+    if not rows:
+        return {}
+
+    _ensure_parents(rows)
+
+    cache_key = (_rows_signature(rows), 'layered', node_w, node_h, h_gap, v_gap)
+    cached = _layout_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    nodes_map, pc_ids, children_by_parent, preds_by_next, _, _ = _aux(rows)
+
+    # 1) Формирование слоёв
+    # Список списков по уровню вместо defaultdict: без __missing__ и
+    # хэширования ключа на каждое добавление
+    layers_list: List[List[int]] = []
+    node_to_layer: Dict[int, int] = {}
+    components = _build_components(rows)
+
+    q = collections.deque([(r.index, 0) for r in rows if r.parent_npc is None and r.index not in pc_ids])
+
+    while q:
+        node_idx, level = q.popleft()
+        if node_idx in node_to_layer:
+            continue
+        node_to_layer[node_idx] = level
+        while len(layers_list) <= level:
+            layers_list.append([])
+        layers_list[level].append(node_idx)
+        node = nodes_map[node_idx]
+        if node_idx not in pc_ids:
+            for child_idx in children_by_parent.get(node_idx, ()):
+                q.append((child_idx, level + 1))
+        else:
+            if node.next and node.next in nodes_map:
+                q.append((node.next, level + 1))
+
+    # На границе API остаётся словарь {уровень -> узлы}
+    layers: Dict[int, List[int]] = {lvl: lst for lvl, lst in enumerate(layers_list)}
+
+    # 2) Барицентрический порядок
+    sorted_levels = range(len(layers_list))  # уровни заведомо плотные: 0..L-1
+    for _ in range(BARYCENTER_ITERATIONS):
+        changed = False
+        for level in sorted_levels:
+            barycenters = {}
+            # Позиции предыдущего слоя одним словарём: prev.index(n) — это
+            # линейный скан на каждого соседа
+            pos_in_prev = {n: i for i, n in enumerate(layers.get(level - 1, []))}
+            for node_idx in layers[level]:
+                node = nodes_map[node_idx]
+                if node_idx in pc_ids and node.parent_npc is not None:
+                    neighbors = [node.parent_npc]
+                else:
+                    neighbors = preds_by_next.get(node_idx, ())
+                if not neighbors:
+                    barycenters[node_idx] = 0
+                else:
+                    pos = [p for p in map(pos_in_prev.get, neighbors) if p is not None]
+                    barycenters[node_idx] = sum(pos) / len(pos) if pos else 0
+            layer_nodes = layers[level]
+            keys = [barycenters[i] for i in layer_nodes]
+            order = sorted(range(len(layer_nodes)), key=keys.__getitem__)
+            reordered = [layer_nodes[k] for k in order]
+            if reordered != layer_nodes:
+                layer_nodes[:] = reordered
+                changed = True
+        # Порядок стабилизировался — выходим раньше пятой итерации
+        if not changed:
+            break
+
+    # 3) Координаты
+    positions: Dict[int, Tuple[float, float]] = {}
+    component_offset_x = 0
+    for comp in components:
+        if not comp:
+            continue
+        comp_layers: Dict[int, List[int]] = collections.defaultdict(list)
+        min_level = 10 ** 9
+        # Итерируем по компоненте, а не по всему node_to_layer: суммарно O(N)
+        # вместо O(компоненты * N); дальше важна только принадлежность слою
+        for node_idx in comp:
+            lvl = node_to_layer.get(node_idx)
+            if lvl is None:
+                continue
+            if lvl < min_level:
+                min_level = lvl
+            comp_layers[lvl].append(node_idx)
+
+        max_width = 0
+        for level in sorted(comp_layers.keys()):
+            ordered = [n for n in layers.get(level, []) if n in comp_layers[level]]
+            y = (level - min_level) * (node_h + v_gap)
+            layer_width = len(ordered) * (node_w + h_gap)
+            max_width = max(max_width, layer_width)
+            start_x = component_offset_x - layer_width / 2
+            if _np is not None and len(ordered) > 64:
+                # Широкий слой: одна векторная операция вместо цикла
+                xs = (start_x + _np.arange(len(ordered), dtype=_np.float64)
+                      * (node_w + h_gap)).tolist()
+                positions.update(zip(ordered, ((x, y) for x in xs)))
+            else:
+                for i, idx in enumerate(ordered):
+                    x = start_x + i * (node_w + h_gap)
+                    positions[idx] = (x, y)
+        component_offset_x += max_width + h_gap * 4
+    _layout_cache_put(cache_key, positions)
+    return positions
+
+
+def calculate_tree_layout(
+    rows: List[DlgRow],
+    *,
+    orientation: str = "vertical",
+    node_w: int = NODE_W_BASE,
+    node_h: int = NODE_H_BASE,
+    h_gap: int = H_GAP_BASE,
+    v_gap: int = V_GAP_BASE,
+) -> Dict[int, Tuple[float, float]]:
+    """
+    Деревообразная раскладка (лес) с чередованием слоёв NPC→PC→NPC.
+    orientation: 'vertical' — корни сверху; 'horizontal' — слева.
+    ВАЖНО: компоненты теперь пакуются в сетку (grid), а не в один «широкий ряд».
+    """
+    if not rows:
+        return {}
+
+    cache_key = (_rows_signature(rows), 'tree', orientation, node_w, node_h, h_gap, v_gap)
+    cached = _layout_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    disk_path = _disk_cache_path(rows, ('tree', orientation, node_w, node_h, h_gap, v_gap))
+    cached = _disk_cache_load(disk_path)
+    if cached is not None:
+        _layout_cache_put(cache_key, cached)
+        return cached
+
+    # --- Подготовка ---
+    # Если у PC отсутствует parent_npc — восстанавливаем по порядку строк
+    # (модульная _ensure_parents; прежний вложенный вариант был пустой
+    # заглушкой). Обязательно до построения смежности
+    _ensure_parents(rows)
+
+    nodes_map, pc_ids, children_by_parent, _, preds_by_next, incoming_to_npc = _aux(rows)
+
+    # --- 1) Корни (NPC без входящих PC→NPC) ---
+    roots = [idx for idx, cnt in incoming_to_npc.items() if cnt == 0]
+    if not roots:
+        # fallback: первый встретившийся NPC
+        first_npc = next((r.index for r in rows if r.index not in pc_ids), None)
+        if first_npc is not None:
+            roots = [first_npc]
+
+    # --- 2) Компоненты и послойка внутри каждого компонента ---
+    components: List[List[int]] = []                  # список индексов узлов по компонентам
+    layers_by_comp: List[Dict[int, List[int]]] = []   # для каждой компоненты: {layer -> [indices]}
+    visited: Set[int] = set()
+
+    # Обход только по «деревянным» ребрам: NPC→PC (parent_npc), PC→NPC (next)
+    def _bfs_layers(root_idx: int) -> Tuple[List[int], Dict[int, List[int]]]:
+        comp_nodes: Set[int] = set()
+        # BFS выдаёт уровни по возрастанию — список списков вместо defaultdict
+        layers_list: List[List[int]] = []
+        dq = collections.deque([(root_idx, 0)])
+        # Локальные ссылки + пакетные update/extend вместо поштучных вызовов
+        vis = visited
+        vis.add(root_idx)
+        children_get = children_by_parent.get
+        popleft = dq.popleft
+        while dq:
+            idx, lvl = popleft()
+            comp_nodes.add(idx)
+            while len(layers_list) <= lvl:
+                layers_list.append([])
+            layers_list[lvl].append(idx)
+            if idx not in pc_ids:  # NPC → дети PC
+                new = [c for c in children_get(idx, ()) if c not in vis]
+                if new:
+                    vis.update(new)
+                    dq.extend((c, lvl + 1) for c in new)
+            else:                        # PC → целевой NPC
+                nxt = nodes_map[idx].next
+                if nxt in nodes_map and nxt not in vis:
+                    vis.add(nxt); dq.append((nxt, lvl + 1))
+        return list(comp_nodes), {lvl: lst for lvl, lst in enumerate(layers_list)}
+
+    # Независимые корни обходим в пуле процессов: компоненты леса обычно
+    # не пересекаются, а BFS + барицентр на компоненту — чистый CPU.
+    # Слияние строго в порядке roots: пересечения достаются первому корню,
+    # как и при последовательном обходе. Любой сбой пула — серийный путь
+    ordered_upto = 0
+    if len(roots) >= 4:
+        try:
+            snapshot = [(r.index, r.parent_npc, r.next, r.index in pc_ids) for r in rows]
+            # Снимок уходит в воркеры один раз через initializer; задания —
+            # только корни, chunksize пачкует их, чтобы IPC не съел выигрыш.
+            # Пул на вызов, а не долгоживущий: initializer привязывает снимок
+            # при создании пула, а граф между перераскладками меняется
+            ncpu = os.cpu_count() or 1
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=ncpu,
+                    initializer=_init_layout_worker, initargs=(snapshot,)) as ex:
+                chunk = max(1, len(roots) // (ncpu * 4))
+                results = list(ex.map(_layout_component, roots, chunksize=chunk))
+        except Exception:
+            results = None
+        if results is not None:
+            for _root, layers in results:
+                comp: List[int] = []
+                filtered: Dict[int, List[int]] = {}
+                for lvl in sorted(layers.keys()):
+                    keep = [i for i in layers[lvl] if i not in visited]
+                    if keep:
+                        visited.update(keep)
+                        filtered[lvl] = keep
+                        comp.extend(keep)
+                if comp:
+                    components.append(comp)
+                    layers_by_comp.append(filtered)
+            # Эти компоненты уже упорядочены воркерами
+            ordered_upto = len(layers_by_comp)
+
+    for root in roots:
+        if root not in visited:
+            comp, layers = _bfs_layers(root)
+            components.append(comp)
+            layers_by_comp.append(layers)
+
+    # Добавим «отвалившиеся» куски, если корни не покрыли все узлы
+    for r in rows:
+        if r.index not in visited:
+            comp, layers = _bfs_layers(r.index)
+            components.append(comp)
+            layers_by_comp.append(layers)
+
+    # --- 3) Упорядочивание слоёв барицентром (минимизация пересечений) ---
+    parent_of = {r.index: r.parent_npc for r in rows}
+    for layers in layers_by_comp[ordered_upto:]:
+        _order_layers(layers, parent_of, pc_ids, preds_by_next)
+
+    # --- 4) КООРДИНАТЫ: упаковка компонентов в «сетку» ---
+    positions: Dict[int, Tuple[float, float]] = {}
+
+    # Предварительно оценим габариты каждой компоненты
+    comp_infos: List[Tuple[int, Dict[int, List[int]], int, int]] = []  # (comp_idx, layers, width_px, height_px)
+    for comp_idx, _comp_nodes in enumerate(components):
+        layers = layers_by_comp[comp_idx]
+        if not layers:
+            comp_infos.append((comp_idx, layers, node_w + h_gap, node_h + v_gap))
+            continue
+        max_nodes_per_layer = max(len(layers[l]) for l in layers)
+        num_layers = (max(layers.keys()) - min(layers.keys()) + 1)
+        comp_w = max_nodes_per_layer * (node_w + h_gap)
+        comp_h = num_layers * (node_h + v_gap)
+        comp_infos.append((comp_idx, layers, comp_w, comp_h))
+
+    # Эвристика числа столбцов: примерно √N
+    ncomps = len(comp_infos)
+    cols = max(1, int(round(ncomps ** 0.5)))
+    margin_x = h_gap * 4   # расстояние между компонентами по «вторичной» оси
+    margin_y = v_gap * 3   # расстояние между рядами
+
+    row_primary_offset = 0.0   # для vertical это Y
+    i = 0
+    while i < ncomps:
+        row = comp_infos[i:i + cols]
+        i += cols
+
+        # Высота ряда = max высоты компонентов; ширина ряда не критична — идём слева направо
+        row_height = max((h for *_t, h in row), default=(node_h + v_gap))
+
+        cur_secondary = 0.0  # для vertical это X
+        for comp_idx, layers, comp_w, _comp_h in row:
+            min_lvl = min(layers.keys()) if layers else 0
+
+            for lvl in sorted(layers.keys()):
+                indices = layers[lvl]
+                secondary_span = len(indices) * (node_w + h_gap)
+                start_secondary = cur_secondary + (comp_w - secondary_span) / 2.0
+                primary = row_primary_offset + (lvl - min_lvl) * (node_h + v_gap)
+                if _np is not None and len(indices) > 64:
+                    # Широкий слой: одна векторная операция вместо цикла
+                    sec = (start_secondary + _np.arange(len(indices), dtype=_np.float64)
+                           * (node_w + h_gap)).tolist()
+                else:
+                    sec = [start_secondary + j * (node_w + h_gap) for j in range(len(indices))]
+                if orientation == "vertical":
+                    positions.update(zip(indices, ((s, primary) for s in sec)))
+                else:
+                    positions.update(zip(indices, ((primary, s) for s in sec)))
+
+            cur_secondary += comp_w + margin_x
+
+        row_primary_offset += row_height + margin_y
+
+    _layout_cache_put(cache_key, positions)
+    _disk_cache_store(disk_path, positions)
+    return positions
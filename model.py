@@ -1,55 +1,109 @@
-import dataclasses
-from typing import Dict, List, Optional
-
-# Константы для обратной совместимости с JSON
-VARIANT_KEYS: List[str] = [
-    "unknown01", "unknown02", "unknown03",
-    "unknown04", "unknown05", "unknown06", "malkavian"
-]
-
-@dataclasses.dataclass
-class DlgRow:
-    """
-    Структура данных, представляющая одну строку (.dlg) или узел диалога.
-    """
-    index: int
-    male: str
-    female: str
-    next: Optional[int]  # None, если реплика NPC ('#')
-    condition: str
-    action: str
-    unknown01: str
-    unknown02: str
-    unknown03: str
-    unknown04: str
-    unknown05: str
-    unknown06: str
-    malkavian: str
-    parent_npc: Optional[int] = None  # Для алгоритма раскладки и трассировок
-
-    def is_pc_reply(self) -> bool:
-        """True, если это реплика игрока (PC)."""
-        return self.next is not None
-
-    def get_variants(self) -> Dict[str, str]:
-        """Все дополнительные варианты."""
-        return {key: getattr(self, key) for key in VARIANT_KEYS}
-
-    def set_variants(self, variants: Dict[str, str]):
-        """Установить значения вариантов из словаря."""
-        for key in VARIANT_KEYS:
-            setattr(self, key, variants.get(key, ""))
-
-    def is_empty_separator(self) -> bool:
-        """
-        Возвращает True, если строка является «пустым разделителем»:
-        NPC-строка (next is None) и все текстовые поля пустые.
-        Такие строки часто используются авторами .dlg как визуальные разделители.
-        """
-        if self.is_pc_reply():
-            return False
-        if any(getattr(self, k).strip() for k in VARIANT_KEYS):
-            return False
-        if any(getattr(self, f).strip() for f in ("male", "female", "condition", "action")):
-            return False
-        return True
+import collections
+import dataclasses
+import operator
+import sys
+from typing import Optional, Tuple
+
+# Константы для обратной совместимости с JSON.
+# Кортеж интернированных строк: итерация по кортежу чуть дешевле списка,
+# а интернирование сводит сравнение имён в getattr к сравнению указателей
+VARIANT_KEYS: Tuple[str, ...] = tuple(sys.intern(k) for k in (
+    "unknown01", "unknown02", "unknown03",
+    "unknown04", "unknown05", "unknown06", "malkavian"
+))
+
+# Один C-вызов attrgetter вместо семи getattr на Python-уровне
+# в горячих get_variants/is_empty_separator
+_VARIANT_GETTER = operator.attrgetter(*VARIANT_KEYS)
+_TEXT_GETTER = operator.attrgetter("male", "female", "condition", "action")
+
+# Плоский именованный кортеж вместо словаря на каждый вызов get_variants:
+# семь слотов без аллокации хэш-таблицы; ._asdict() — для тех, кому нужен dict
+Variants = collections.namedtuple("Variants", VARIANT_KEYS)
+
+# slots= у dataclass появился в Python 3.10; на более старых версиях
+# просто теряем экономию памяти, но остаёмся работоспособными
+_DC_KW = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclasses.dataclass(**_DC_KW)
+class DlgRow:
+    """
+    Структура данных, представляющая одну строку (.dlg) или узел диалога.
+
+    slots=True: без __dict__ каждая строка занимает примерно вдвое меньше
+    памяти, а доступ к полям быстрее — заметно на диалогах в тысячи строк.
+    """
+    index: int
+    male: str
+    female: str
+    next: Optional[int]  # None, если реплика NPC ('#')
+    condition: str
+    action: str
+    unknown01: str
+    unknown02: str
+    unknown03: str
+    unknown04: str
+    unknown05: str
+    unknown06: str
+    malkavian: str
+    parent_npc: Optional[int] = None  # Для алгоритма раскладки и трассировок
+    # Мемоизированный результат is_empty_separator; сбрасывается в
+    # __setattr__ при любой записи поля
+    _sep_cache: Optional[bool] = dataclasses.field(default=None, repr=False, compare=False)
+
+    def __setattr__(self, name, value):
+        if name != "_sep_cache":
+            object.__setattr__(self, "_sep_cache", None)
+        object.__setattr__(self, name, value)
+
+    def is_pc_reply(self) -> bool:
+        """True, если это реплика игрока (PC)."""
+        return self.next is not None
+
+    def content_key(self) -> Tuple:
+        """Хэшируемый кортеж содержимого строки (без layout-метаданных).
+
+        Строки с одинаковым содержимым дают одинаковый ключ — годится для
+        дедупликации через set/dict и быстрых проверок «изменилось ли»
+        без пополевого сравнения.
+        """
+        return (self.index, self.male, self.female, self.next,
+                self.condition, self.action) + _VARIANT_GETTER(self)
+
+    def get_variants(self) -> Variants:
+        """Все дополнительные варианты."""
+        return Variants._make(_VARIANT_GETTER(self))
+
+    def set_variants(self, variants):
+        """Установить значения вариантов из словаря или Variants."""
+        if isinstance(variants, Variants):
+            variants = variants._asdict()
+        for key in VARIANT_KEYS:
+            object.__setattr__(self, key, variants.get(key, ""))
+        object.__setattr__(self, "_sep_cache", None)
+
+    def is_empty_separator(self) -> bool:
+        """
+        Возвращает True, если строка является «пустым разделителем»:
+        NPC-строка (next is None) и все текстовые поля пустые.
+        Такие строки часто используются авторами .dlg как визуальные разделители.
+        Результат кэшируется на строке до следующей записи любого поля.
+        """
+        c = self._sep_cache
+        if c is None:
+            c = self._compute_empty_separator()
+            object.__setattr__(self, "_sep_cache", c)
+        return c
+
+    def _compute_empty_separator(self) -> bool:
+        if self.is_pc_reply():
+            return False
+        # Сначала дешёвые и чаще всего непустые текстовые поля; проверка
+        # «v and not v.isspace()» не аллоцирует строку в отличие от .strip()
+        for v in _TEXT_GETTER(self):
+            if v and not v.isspace():
+                return False
+        for v in _VARIANT_GETTER(self):
+            if v and not v.isspace():
+                return False
+        return True